@@ -2,105 +2,269 @@
 
 from __future__ import annotations
 
+import asyncio
+import errno
+import functools
 import json
 import os
-import queue
-import subprocess
-import threading
+import signal
 import time
 import uuid
+from contextlib import aclosing
 from pathlib import Path
-from typing import Annotated, Any, Dict, Generator, List, Literal, Optional
+from typing import Annotated, Any, AsyncIterator, Dict, List, Literal, Optional
 
 from mcp.server.fastmcp import FastMCP
 from pydantic import BeforeValidator, Field
 import shutil
 
+try:
+    # orjson is optional; json.loads is used when it is not installed.
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 mcp = FastMCP("Gemini MCP Server-from guda.studio")
 
+# Seconds the gemini CLI gets to exit after SIGTERM before it is killed.
+SIGTERM_GRACE = 3.0
+
+# Buffer limit of the subprocess StreamReader (asyncio's default). asyncio
+# pauses reading the pipe once more than twice this much output is buffered,
+# so a slow consumer blocks the CLI's writes after at most 128 KiB per session.
+STREAM_LIMIT = 64 * 1024
+
+# Output is read from the pipe in chunks of this size and split into lines here.
+READ_CHUNK_SIZE = 64 * 1024
+
+# Longest output line kept in memory; longer lines are dropped and replaced
+# with OVERSIZED_LINE so a runaway line cannot grow without bound.
+MAX_LINE_LENGTH = 8 * 1024 * 1024
+OVERSIZED_LINE = f"[dropped an output line longer than {MAX_LINE_LENGTH} bytes]".encode()
+
+# Notice the CLI emits as an assistant message when invoked with --prompt, and
+# the raw-bytes prefix used to rule it out without looking at the content.
+PROMPT_DEPRECATION_NOTICE = "The --prompt (-p) flag has been deprecated and will be removed in a future version. Please use a positional argument for your prompt. See gemini --help for more information.\n"
+PROMPT_DEPRECATION_NEEDLE = b"The --prompt (-p) flag has been deprecated"
+
+# After the gemini CLI fails to launch, calls within this many seconds fail
+# fast instead of probing PATH and spawning it again. A CLI installed during
+# that window is only picked up once it has expired.
+MISSING_CLI_TTL = 5.0
+_missing_cli_until = 0.0
+
+
+@functools.lru_cache(maxsize=1)
+def _gemini_path() -> str:
+    """Resolve the gemini executable on PATH once for the lifetime of the server."""
+    return shutil.which("gemini") or "gemini"
+
+
+class GeminiTimeoutError(TimeoutError):
+    """Raised when the gemini CLI does not finish within the allotted time."""
+
+
+class GeminiNotFoundError(FileNotFoundError):
+    """Raised when the gemini CLI executable cannot be launched."""
+
+
+async def wait_for_exit(process: asyncio.subprocess.Process) -> None:
+    """Wait until the process exits, even if a grandchild still holds its pipes open.
+
+    On Linux this polls a pidfd from the event loop; elsewhere it falls back to
+    `process.wait()`, which also waits for the pipes to close.
+    """
+    if process.returncode is not None:
+        return
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except ProcessLookupError:
+        return
+    except (AttributeError, OSError):
+        await process.wait()
+        return
+
+    loop = asyncio.get_running_loop()
+    exited: asyncio.Future[None] = loop.create_future()
+    try:
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        await exited
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+
+
+def signal_process_group(process: asyncio.subprocess.Process, sig: int) -> None:
+    """Send a signal to the process and, on POSIX, every process in its group."""
+    try:
+        if os.name == "nt":
+            process.send_signal(sig)
+        else:
+            os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+async def terminate_process(process: asyncio.subprocess.Process, grace: float = SIGTERM_GRACE) -> None:
+    """Stop the process with SIGTERM, escalating to SIGKILL after `grace` seconds.
+
+    The command runs in its own process group, so anything the gemini CLI
+    spawned is signalled along with it instead of being left orphaned.
+    """
+    signal_process_group(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(wait_for_exit(process), timeout=grace)
+    except TimeoutError:
+        signal_process_group(process, getattr(signal, "SIGKILL", signal.SIGTERM))
+        await wait_for_exit(process)
+
 
-def run_shell_command(cmd: list[str], cwd: str | None = None) -> Generator[str, None, None]:
+async def run_shell_command(
+    cmd: list[str], cwd: str | None = None, timeout: float | None = None
+) -> AsyncIterator[tuple[bytes, Optional[Dict[str, Any]]]]:
     """Execute a command and stream its output line-by-line.
 
+    Output is kept as raw bytes; each line is parsed as JSON exactly once,
+    here, so consumers of the stream-json output never decode or parse it again.
+
     Args:
         cmd: Command and arguments as a list (e.g., ["gemini", "-o", "stream-json", "--", "prompt"])
         cwd: Working directory for the command
+        timeout: Maximum seconds to wait for the command, or None for no limit
 
     Yields:
-        Output lines from the command
-    """
-    popen_cmd = cmd
+        Tuples of (raw output line, parsed JSON object or None if the line is not one)
 
-    gemini_path = shutil.which("gemini") or cmd[0]
-    popen_cmd[0] = gemini_path
-
-    # if os.name == "nt" and gemini_path.lower().endswith((".cmd", ".bat")):
+    Raises:
+        GeminiNotFoundError: If the gemini executable cannot be found
+        GeminiTimeoutError: If the command is still running after `timeout` seconds
+    """
+    # if os.name == "nt" and _gemini_path().lower().endswith((".cmd", ".bat")):
     #     from subprocess import list2cmdline
-    #     popen_cmd = ["cmd.exe", "/s", "/c", list2cmdline(cmd)]
-
-    process = subprocess.Popen(
-        popen_cmd,
-        shell=False,
-        stdin=subprocess.DEVNULL,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        universal_newlines=True,
-        encoding='utf-8',
+    #     cmd = ["cmd.exe", "/s", "/c", list2cmdline(cmd)]
+
+    spawn = functools.partial(
+        asyncio.create_subprocess_exec,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
         cwd=cwd,
+        limit=STREAM_LIMIT,
+        process_group=0,
     )
-
-    output_queue: queue.Queue[str | None] = queue.Queue()
-    GRACEFUL_SHUTDOWN_DELAY = 0.3
-
-    def is_turn_completed(line: str) -> bool:
-        """Check if the line indicates turn completion via JSON parsing."""
+    global _missing_cli_until
+    if time.monotonic() < _missing_cli_until:
+        raise GeminiNotFoundError(errno.ENOENT, "could not be launched recently", _gemini_path())
+    # `cmd` is passed through untouched; the resolved path goes in as the
+    # executable, so neither a copy nor an in-place rewrite of cmd[0] is needed.
+    # Popen also raises FileNotFoundError for a missing `cwd`; only errors that
+    # name the executable count as the CLI being missing.
+    executable = _gemini_path()
+    try:
+        process = await spawn(*cmd, executable=executable)
+    except FileNotFoundError as error:
+        if error.filename != executable:
+            raise
+        # The cached path went stale (e.g. the CLI was reinstalled); look it up again.
+        _gemini_path.cache_clear()
+        executable = _gemini_path()
         try:
-            data = json.loads(line)
-            return data.get("type") == "turn.completed"
-        except (json.JSONDecodeError, AttributeError, TypeError):
-            return False
-
-    def read_output() -> None:
-        """Read process output in a separate thread."""
-        if process.stdout:
-            for line in iter(process.stdout.readline, ""):
-                stripped = line.strip()
-                output_queue.put(stripped)
-                if is_turn_completed(stripped):
-                    time.sleep(GRACEFUL_SHUTDOWN_DELAY)
-                    process.terminate()
-                    break
-            process.stdout.close()
-        output_queue.put(None)
-
-    thread = threading.Thread(target=read_output)
-    thread.start()
-
-    # Yield lines while process is running
-    while True:
+            process = await spawn(*cmd, executable=executable)
+        except FileNotFoundError as error:
+            if error.filename != executable:
+                raise
+            _missing_cli_until = time.monotonic() + MISSING_CLI_TTL
+            raise GeminiNotFoundError(error.errno, error.strerror, error.filename) from error
+
+    # How long to keep collecting trailing output once the turn has completed
+    # or the CLI has exited, before the process is shut down.
+    DRAIN_TIMEOUT = 0.05
+
+    def parse_line(line: bytes) -> Optional[Dict[str, Any]]:
+        """Parse a stream-json event, returning None for anything that is not a JSON object."""
+        if not line.startswith(b"{"):
+            return None
         try:
-            line = output_queue.get(timeout=0.5)
-            if line is None:
-                break
-            yield line
-        except queue.Empty:
-            if process.poll() is not None and not thread.is_alive():
-                break
+            data = json_loads(line)
+        except ValueError:
+            # JSONDecodeError, or UnicodeDecodeError from stdlib json on non-UTF-8 bytes.
+            return None
+        return data if isinstance(data, dict) else None
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout if timeout else None
+    exited = asyncio.ensure_future(wait_for_exit(process))
+    draining = False
+    pending: List[bytes] = []
+    pending_size = 0
+    oversized = False
 
     try:
-        process.wait(timeout=5)
-    except subprocess.TimeoutExpired:
-        process.kill()
-        process.wait()
-    thread.join(timeout=5)
-
-    while not output_queue.empty():
-        try:
-            line = output_queue.get_nowait()
-            if line is not None:
-                yield line
-        except queue.Empty:
-            break
+        if process.stdout:
+            while True:
+                remaining = deadline - loop.time() if deadline is not None else None
+                reading = asyncio.ensure_future(process.stdout.read(READ_CHUNK_SIZE))
+                done, _ = await asyncio.wait(
+                    {reading, exited}, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+                )
+                # Set when this is the last chunk to be collected before stopping.
+                final = False
+                if not done:
+                    if not draining:
+                        reading.cancel()
+                        raise GeminiTimeoutError(f"gemini did not finish within {timeout} seconds")
+                    final = True
+                    # The read may have completed in the same iteration the drain
+                    # window closed; its data is already off the stream, so keep it.
+                    if reading.done() and not reading.cancelled():
+                        chunk = reading.result()
+                    else:
+                        reading.cancel()
+                        chunk = b""
+                elif reading in done:
+                    chunk = reading.result()
+                else:
+                    # The child is gone; only collect what it already wrote.
+                    try:
+                        chunk = await asyncio.wait_for(reading, timeout=DRAIN_TIMEOUT)
+                    except TimeoutError:
+                        final = True
+                        chunk = b""
+                lines: List[bytes] = []
+                if chunk and b"\n" not in chunk:
+                    if not oversized:
+                        pending.append(chunk)
+                        pending_size += len(chunk)
+                        if pending_size > MAX_LINE_LENGTH:
+                            pending, pending_size, oversized = [], 0, True
+                elif chunk:
+                    *lines, tail = chunk.split(b"\n")
+                    if oversized or pending_size + len(lines[0]) > MAX_LINE_LENGTH:
+                        lines[0] = OVERSIZED_LINE
+                        oversized = False
+                    elif pending:
+                        pending.append(lines[0])
+                        lines[0] = b"".join(pending)
+                    pending, pending_size = [tail], len(tail)
+                if not chunk or final:
+                    # EOF, or giving up on the stream: whatever is left is an
+                    # unterminated final line.
+                    lines.append(OVERSIZED_LINE if oversized else b"".join(pending))
+                for raw_line in lines:
+                    stripped = raw_line.strip()
+                    if not stripped:
+                        continue
+                    data = parse_line(stripped)
+                    yield stripped, data
+                    if data is not None and data.get("type") == "turn.completed":
+                        draining = True
+                        drain_until = loop.time() + DRAIN_TIMEOUT
+                        deadline = drain_until if deadline is None else min(deadline, drain_until)
+                if not chunk or final:
+                    break
+    finally:
+        exited.cancel()
+        await terminate_process(process)
 
 
 def windows_escape(prompt):
@@ -166,6 +330,10 @@ async def gemini(
         str,
         "The model to use for the gemini session. This parameter is strictly prohibited unless explicitly specified by the user.",
     ] = "",
+    timeout: Annotated[
+        int,
+        Field(ge=0, description="Maximum number of seconds to wait for the gemini session. Defaults to `0`, no limit."),
+    ] = 0,
 ) -> Dict[str, Any]:
     """Execute a gemini CLI session and return the results."""
     
@@ -191,41 +359,62 @@ async def gemini(
         cmd.extend(["--resume", SESSION_ID])
 
     all_messages = []
-    agent_messages = ""
+    agent_parts: List[str] = []
     success = True
-    err_message = ""
+    err_parts: List[str] = []
     thread_id: Optional[str] = None
+    # The CLI prints the deprecation notice at most once per session.
+    deprecation_seen = False
 
-    for line in run_shell_command(cmd, cwd=cd.absolute().as_posix()):
-        try:
-            line_dict = json.loads(line.strip())
-            all_messages.append(line_dict)
-            item_type = line_dict.get("type", "")
-            item_role = line_dict.get("role", "")
-            if item_type == "message" and item_role == "assistant":
-                if (
-                    "The --prompt (-p) flag has been deprecated and will be removed in a future version. Please use a positional argument for your prompt. See gemini --help for more information.\n"
-                    in line_dict.get("content", "")
-                ):
+    try:
+        async with aclosing(
+            run_shell_command(cmd, cwd=cd.absolute().as_posix(), timeout=timeout or None)
+        ) as output_lines:
+            async for line, line_dict in output_lines:
+                if line_dict is None:
+                    err_parts.append("\n\n[json decode error] " + line.decode("utf-8", errors="replace"))
                     continue
-                agent_messages = agent_messages + line_dict.get("content", "")
-            if line_dict.get("session_id") is not None:
-                thread_id = line_dict.get("session_id")
-            # if "fail" in line_dict.get("type", ""):
-            #     success = False
-            #     err_message = "gemini error: " + line_dict.get("error", {}).get("message", "")
-            #     break
-            # if "error" in line_dict.get("type", ""):
-            #     success = False
-            #     err_message = "gemini error: " + line_dict.get("message", "")
-        except json.JSONDecodeError as error:
-            # Improved error handling: include problematic line
-            err_message += "\n\n[json decode error] " + line
-            continue
-        except Exception as error:
-            err_message += "\n\n[unexpected error] " + f"Unexpected error: {error}. Line: {line!r}"
-            break
+                try:
+                    if return_all_messages:
+                        all_messages.append(line_dict)
+                    item_type = line_dict.get("type", "")
+                    item_role = line_dict.get("role", "")
+                    if item_type == "message" and item_role == "assistant":
+                        content = line_dict.get("content", "")
+                        if not isinstance(content, str):
+                            raise TypeError(f"assistant content must be str, not {type(content).__name__}")
+                        if (
+                            not deprecation_seen
+                            and PROMPT_DEPRECATION_NEEDLE in line
+                            and PROMPT_DEPRECATION_NOTICE in content
+                        ):
+                            deprecation_seen = True
+                            continue
+                        agent_parts.append(content)
+                    session_id = line_dict.get("session_id")
+                    if session_id is not None:
+                        thread_id = session_id
+                    # if "fail" in line_dict.get("type", ""):
+                    #     success = False
+                    #     err_message = "gemini error: " + line_dict.get("error", {}).get("message", "")
+                    #     break
+                    # if "error" in line_dict.get("type", ""):
+                    #     success = False
+                    #     err_message = "gemini error: " + line_dict.get("message", "")
+                except Exception as error:
+                    err_parts.append("\n\n[unexpected error] " + f"Unexpected error: {error}. Line: {line.decode('utf-8', errors='replace')!r}")
+                    break
+    except GeminiTimeoutError as error:
+        success = False
+        err_parts.append("\n\n[timeout] " + str(error))
+    except GeminiNotFoundError:
+        success = False
+        err_parts.append(
+            "\n\n[not found] The gemini CLI could not be found. Please make sure it is installed and on PATH, then try again."
+        )
 
+    agent_messages = "".join(agent_parts)
+    err_message = "".join(err_parts)
 
     if thread_id is None:
         success = False